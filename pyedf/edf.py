@@ -2,9 +2,13 @@
 Methods for dealing with EDF+ files.
 """
 
-from struct import unpack, calcsize
+import os
+
+from struct import Struct
 from collections import namedtuple
 
+import numpy as np
+
 def _scale(v, s, d):
     return ((v-s[0])/(s[1]-s[0])) * (d[1]-d[0]) + d[0]
 
@@ -26,6 +30,44 @@ _SignalHeader = namedtuple('EdfSignalHeader',
 # Useful structures
 _Timestamp = namedtuple('EdfTime', 'h m s')
 
+# EDF+ main header is fixed-size, so its Struct can be built once
+_hdr_struct = Struct('<8s80s80s8s8s8s44s8s8s4s')
+
+# Signal headers store each field for every signal in turn
+_shdr_size = {
+        'label':16, 'ttype':80, 'pdim':8, 'pmin':8, 'pmax':8,
+        'dmin':8, 'dmax':8, 'preflt':80, 'nsample':8, 'reserved':32
+        }
+
+_shdr_order = [
+        'label', 'ttype', 'pdim', 'pmin', 'pmax',
+        'dmin', 'dmax', 'preflt', 'nsample', 'reserved'
+        ]
+
+# Signal header Structs only depend on the number of signals; cache them
+# so files with the same montage share them
+_shdr_structs = {}
+
+def _shdr_struct(nsig):
+    s = _shdr_structs.get(nsig)
+    if s is None:
+        s = _shdr_structs[nsig] = Struct('<' + ''.join(
+                '{}s'.format(_shdr_size[k]) * nsig for k in _shdr_order
+                ))
+    return s
+
+# CUDA kernel for read_cuda(), compiled on first use
+_cuda_scale = None
+
+def _cuda_scale_kernel():
+    global _cuda_scale
+    if _cuda_scale is None:
+        import cupy as cp
+        _cuda_scale = cp.ElementwiseKernel(
+                'T x, K k, K b', 'F y', 'y = (F)((K)x * k + b)', 'pyedf_scale'
+                )
+    return _cuda_scale
+
 
 class EdfData(list):
     def __init__(self, s, d):
@@ -42,119 +84,260 @@ class EdfFile(object):
         """Reads an EDF+ file from disk and returns an EdfFile object."""
 
         # Decode bytes to strings
-        bdecode = lambda bl: [b.decode("ascii").strip() for b in bl]
+        bstr    = lambda b: b.strip().decode("ascii")
+        bdecode = lambda bl: [bstr(b) for b in bl]
 
         # EDF+ Specifications
-        hdr_fmt  = '<8s80s80s8s8s8s44s8s8s4s'
-        hdr_size = calcsize(hdr_fmt)
-
-        shdr_size = {
-                'label':16, 'ttype':80, 'pdim':8, 'pmin':8, 'pmax':8,
-                'dmin':8, 'dmax':8, 'preflt':80, 'nsample':8, 'reserved':32
-                }
-
-        shdr_order = [
-                'label', 'ttype', 'pdim', 'pmin', 'pmax',
-                'dmin', 'dmax', 'preflt', 'nsample', 'reserved'
-                ]
+        hdr_size = _hdr_struct.size
 
+        # int() and float() parse the space-padded bytes directly
         shdr_type = {
-                'label':str, 'ttype':str, 'pdim':str, 'pmin':float, 'pmax':float,
-                'dmin':int, 'dmax':int, 'preflt':str, 'nsample':int, 'reserved':str
+                'label':bstr, 'ttype':bstr, 'pdim':bstr, 'pmin':float, 'pmax':float,
+                'dmin':int, 'dmax':int, 'preflt':bstr, 'nsample':int, 'reserved':bstr
                 }
 
         # Initialise
         self.header = None
         self.signals = []
         self.filename = filename
+        self.nbyte = 0
+        self.ndata = 0
+        self.record_duration = 0.0
+        self.nsample = None
+        self.pmin = None
+        self.pmax = None
+        self.dmin = None
+        self.dmax = None
         self._data_record_size = 0
-        self._sigfmt = "<{}h"
-
-
-        with open(filename, "rb") as f:
+        self._nint = 0
+        self._split_idx = None
+        self._uniform = False
+        self._uniform_nsample = None
+        self._scale_k = None
+        self._scale_b = None
+        self._qscale = None
+        self._data = None
+
+
+        # Only two exact-sized reads are made, so skip the read buffer
+        with open(filename, "rb", buffering=0) as f:
             # Try and read the entire header
             hdr_bytes = f.read(hdr_size)
 
             if len(hdr_bytes) != hdr_size:
                 raise BadEdfException
 
-            self.header = _EdfHeader._make( bdecode(unpack(hdr_fmt, hdr_bytes)) )
+            self.header = _EdfHeader._make( bdecode(_hdr_struct.unpack(hdr_bytes)) )
 
             curpos = f.tell()
             if curpos != hdr_size:
                 raise BadEdfException
 
-            # Get signal headers
-            def unpack_array(count, size, formatter):
-                fmt   = '<' + '{}s'.format(size) * count
-                csize = calcsize(fmt)
-                b     = f.read(csize)
-                if len(b) != csize:
-                    raise BadEdfException
-                return list( map(formatter, bdecode(unpack(fmt, b))) )
-                
+            # Numeric main header fields, parsed once
+            self.nbyte = int(self.header.nbyte)
+            self.ndata = int(self.header.ndata)
+            self.record_duration = float(self.header.duration)
+
+            # Signal headers are stored contiguously after the main header,
+            # so fetch them in one read and unpack each field from memory
+            rest = self.nbyte - hdr_size
+            if rest < 0:
+                raise BadEdfException
+
+            buf = f.read(rest)
+            if len(buf) != rest:
+                raise BadEdfException
+
+            # One Struct covers every field of every signal, field by field
             nsig = int(self.header.nsignal)
-            sdata = {
-                    k:unpack_array(nsig, shdr_size[k], shdr_type[k]) 
-                    for k in shdr_order
-                    }
+            st = _shdr_struct(nsig)
 
             # Check we have read all the header data
-            curpos = f.tell()
-            if curpos != int(self.header.nbyte):
+            if st.size != rest:
                 raise BadEdfException
 
-            sdata['offset'] = []
-            offset = 0
-            for ns in sdata['nsample']:
-                sdata['offset'].append(offset)
-                offset += calcsize(self._sigfmt.format(int(ns)))
-            self._data_record_size = offset
+            vals  = st.unpack(buf)
+            sdata = {
+                    k:list( map(shdr_type[k], vals[i*nsig:(i+1)*nsig]) )
+                    for i, k in enumerate(_shdr_order)
+                    }
+
+            # Columnar copies of the numeric signal header fields
+            self.nsample = np.array(sdata['nsample'], dtype=np.int32)
+            self.pmin = np.array(sdata['pmin'], dtype=np.float64)
+            self.pmax = np.array(sdata['pmax'], dtype=np.float64)
+            self.dmin = np.array(sdata['dmin'], dtype=np.int32)
+            self.dmax = np.array(sdata['dmax'], dtype=np.int32)
+
+            # Each data record is nsample * nsignal 2-byte integers, split
+            # at the boundaries between signals
+            bounds = np.cumsum(self.nsample)
+            self._split_idx = bounds[:-1]
+            self._nint = int(bounds[-1]) if nsig > 0 else 0
+            self._data_record_size = 2 * self._nint
+
+            sdata['offset'] = [0] + (2 * self._split_idx).tolist()
+
+            # Most files use the same sample count for every signal, in
+            # which case a record is split with a reshape
+            self._uniform = nsig > 0 and bool((self.nsample == self.nsample[0]).all())
+            if self._uniform:
+                self._uniform_nsample = int(self.nsample[0])
+
+            # Digital to physical conversion is linear per signal; expand
+            # it to one scale/offset per sample column of a data record.
+            # A signal with dmin == dmax has no valid scale, but that only
+            # matters if physical values are read.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                k = (self.pmax - self.pmin) / (self.dmax - self.dmin)
+                b = self.pmin - self.dmin * k
+            self._scale_k = np.repeat(k, self.nsample)
+            self._scale_b = np.repeat(b, self.nsample)
+
+            # int8 quantisation maps each signal's largest physical
+            # magnitude onto 127
+            peak = np.maximum(np.abs(self.pmin), np.abs(self.pmax))
+            peak[peak == 0] = 1
+            self._qscale = np.repeat(127 / peak, self.nsample).astype(np.float32)
 
             for i in range(nsig):
                 d = {k:v[i] for k,v in sdata.items()}
                 self.signals.append(_SignalHeader(**d))
 
             # Calculate total duration
-            seconds = float(self.header.duration) * int(self.header.ndata)
+            seconds = self.record_duration * self.ndata
             mins, secs  = divmod(seconds, 60)
             hours, mins = divmod(mins, 60)
             self.duration = _Timestamp._make([hours, mins, secs])
 
+    def read_memmap(self):
+        """
+        Returns the data records as a read-only (ndata, nsample) int16
+        memmap, with the samples of each signal stored contiguously in
+        the order given by self.signals. The mapping is created on first
+        use and shared by later calls.
+        """
+
+        if self._data is not None:
+            return self._data
+
+        spos  = self.nbyte
+        rsize = self._data_record_size
+        nbyte = os.path.getsize(self.filename) - spos
+        ndata = nbyte // rsize if rsize > 0 else 0
+
+        left = nbyte - ndata * rsize
+        if left > 0:
+            print("Warning: reached end of file. {}/{} bytes left."
+                    .format(left, rsize)
+                    )
+
+        if ndata == 0:
+            self._data = np.empty((0, self._nint), dtype='<i2')
+        else:
+            self._data = np.memmap(self.filename, dtype='<i2', mode='r',
+                    offset=spos, shape=(ndata, self._nint)
+                    )
+
+        return self._data
+
     def read(self):
         """Returns all data records."""
 
-        spos  = int(self.header.nbyte)
-        ndata = int(self.header.ndata) 
-        nsig  = len(self.signals)
-        recs  = []
-
-        with open(self.filename, "rb") as f:
-            f.seek(spos)
-            while True:
-                byt = f.read(self._data_record_size)
-
-                # Keep reading until we run out of stuff to read
-                if len(byt) == 0:
-                    break
-                if len(byt) < self._data_record_size:
-                    print("Warning: reached end of file. {}/{} bytes left."
-                            .format(len(byt), self._data_record_size)
-                            )
-                    break
-
-                # byt is nsample * nsignal integers
-                nint = sum([s.nsample for s in self.signals])
-                fmt  = self._sigfmt.format(nint)
-                ints = unpack(fmt, byt)
-
-                dat = []
-                i   = 0
-                for s in self.signals:
-                    dat.append(EdfData(s, ints[i:i+s.nsample]))
-                    i += s.nsample
-
-                recs.append(dat)
+        data = self.read_memmap()
+        nsig = len(self.signals)
+
+        recs = []
+        for rec in data:
+            if self._uniform:
+                parts = rec.reshape(nsig, self._uniform_nsample).tolist()
+            else:
+                parts = [p.tolist() for p in np.split(rec, self._split_idx)]
+
+            recs.append([EdfData(s, p) for s, p in zip(self.signals, parts)])
 
         return recs
 
+    def iter_records(self):
+        """
+        Yields data records one at a time, each as a list with one int16
+        array per signal. The arrays are views into the file mapping.
+        """
+
+        nsig = len(self.signals)
+
+        for rec in self.read_memmap():
+            if self._uniform:
+                yield list(rec.reshape(nsig, self._uniform_nsample))
+            else:
+                yield np.split(rec, self._split_idx)
+
+    def signal(self, i):
+        """
+        Returns every sample of signal i as a (ndata, nsample) int16 view,
+        one row per data record. Use .ravel() for a flat (copied) array.
+        """
+
+        start = self.signals[i].offset // 2
+        return self.read_memmap()[:, start:start + self.signals[i].nsample]
+
+    def read_physical(self, dtype=np.float32):
+        """
+        Returns all data records as an array of physical values, with the
+        same (ndata, nsample) layout as read_memmap(). Pass np.float64 for
+        full precision or np.float16 for a half-size output.
+        """
+
+        data = self.read_memmap()
+
+        # Scale and offset broadcast across all records in one pass each.
+        # Narrow outputs are computed in float32 and cast once at the end,
+        # since rounding data*k before adding b loses small values.
+        ctype = np.result_type(dtype, np.float32)
+        out   = np.empty(data.shape, dtype=ctype)
+        np.multiply(data, self._scale_k.astype(ctype, copy=False), out=out)
+        out += self._scale_b.astype(ctype, copy=False)
+
+        return out.astype(dtype, copy=False)
+
+    def read_int8(self):
+        """
+        Returns all data records as physical values quantised to int8,
+        along with the per-sample-column scale used. Physical values are
+        recovered as data / qscale.
+        """
+
+        data = self.read_memmap()
+        out  = np.empty(data.shape, dtype=np.float32)
+
+        # Fold the quantisation scale into the physical conversion.
+        # Signals with dmin == dmax have no valid scale and read as 0.
+        k = np.nan_to_num(self._scale_k * self._qscale, nan=0, posinf=0, neginf=0)
+        b = np.nan_to_num(self._scale_b * self._qscale, nan=0, posinf=0, neginf=0)
+        np.multiply(data, k.astype(np.float32), out=out)
+        out += b.astype(np.float32)
+        np.rint(out, out=out)
+        np.clip(out, -127, 127, out=out)
+
+        return out.astype(np.int8), self._qscale.copy()
+
+    def read_cuda(self, dtype=np.float32):
+        """
+        Returns all data records as a CuPy array of physical values on the
+        current GPU, with the same layout as read_physical(). Requires
+        CuPy.
+        """
+
+        import cupy as cp
+
+        # As in read_physical(), narrow outputs are computed in float32
+        ctype = np.result_type(dtype, np.float32)
+
+        data = cp.asarray(self.read_memmap())
+        k = cp.asarray(self._scale_k, dtype=ctype)
+        b = cp.asarray(self._scale_b, dtype=ctype)
+        out = cp.empty(data.shape, dtype=dtype)
+
+        # Conversion and scaling happen in a single elementwise kernel,
+        # rounding to the output dtype only when each value is stored
+        return _cuda_scale_kernel()(data, k, b, out)
@@ -3,14 +3,34 @@ Methods for dealing with RAW (simple binary format) files from NetStation.
 Only continuous files are supported.
 """
 
-from struct import unpack, calcsize
+import io
+import os
+
+from struct import Struct
 from collections import namedtuple
 
+import numpy as np
+
 # Header
 _RawHeader = namedtuple('RawHeader',
         'version year month day hour min s ms rate nchan gain nconv amprange nsample nevent'
         )
 
+_hdr_struct = Struct('>i6hi5hih')
+
+# Event code and record Structs depend on the channel/event counts;
+# cache them so files with the same layout share them
+_structs = {}
+
+def _struct(fmt):
+    s = _structs.get(fmt)
+    if s is None:
+        s = _structs[fmt] = Struct(fmt)
+    return s
+
+# Minimum number of data records fetched from disk per read
+_CHUNK_RECORDS = 64
+
 class BadRawException(Exception):
     """Raised if the file is not in the correct EDF+ format."""
     pass
@@ -19,15 +39,15 @@ class RawFile(object):
     """Representation of a RAW file."""
 
     def __init__(self, filename):
-        import os
-
         if not os.path.exists(filename):
             raise BadRawException('File does not exist.')
 
         self.filename = filename
 
     def __enter__(self):
-        self._fhandle = open(self.filename, 'rb')
+        # Records are read into our own buffer, so the file is opened
+        # unbuffered to avoid copying everything through a second one
+        self._fhandle = open(self.filename, 'rb', buffering=0)
         self._read_header()
         return self
 
@@ -41,15 +61,12 @@ class RawFile(object):
         f = self._fhandle
 
         # Read the header
-        hdr_fmt = '>i6hi5hih'
-        hdr_size = calcsize(hdr_fmt)
-
-        b = f.read(hdr_size)
+        b = f.read(_hdr_struct.size)
 
-        if len(b) != hdr_size:
+        if len(b) != _hdr_struct.size:
             raise BadRawException('Incomplete header.')
         
-        self.header = _RawHeader._make(unpack(hdr_fmt, b))
+        self.header = _RawHeader._make(_hdr_struct.unpack(b))
 
         # Determine filetype first from first four bytes (big-endian)
         # 2 = integer, 4 = single FP, 6 = double FP
@@ -70,15 +87,14 @@ class RawFile(object):
         nchar = 4
         ncodes = self.header.nevent
 
-        code_fmt = '>' + '{}s'.format(nchar) * ncodes
-        code_size = calcsize(code_fmt)
+        code_struct = _struct('>' + '{}s'.format(nchar) * ncodes)
 
-        b = f.read(code_size)
+        b = f.read(code_struct.size)
 
-        if len(b) != code_size:
+        if len(b) != code_struct.size:
             raise BadRawException('Incomplete event code listing.')
 
-        self.codes = unpack(code_fmt, b)
+        self.codes = code_struct.unpack(b)
 
         # Store where the data records begin
         self._data_offset = f.tell()
@@ -86,8 +102,50 @@ class RawFile(object):
         # Calculate size of individual data record
         nchan = self.header.nchan
         self._rec_fmt = '>{}{}'.format(nchan+ncodes, self.rep[1])
-        self._rec_size = calcsize(self._rec_fmt)
+        self._rec_size = _struct(self._rec_fmt).size
 
+        # Channel values are unpacked as a tuple, event flags are decoded
+        # for a whole chunk at once and used to mask the event codes
+        self._chan_struct = _struct('>{}{}'.format(nchan, self.rep[1]))
+        self._dtype = np.dtype('>' + self.rep[1])
+        self._codes_arr = np.array(self.codes, dtype=object)
+        self._events = None
+
+        # Records are read in chunks into a reusable buffer, at an
+        # explicit file position rather than the handle's own offset
+        nrec = max(_CHUNK_RECORDS, io.DEFAULT_BUFFER_SIZE // max(self._rec_size, 1))
+        self._pos = self._data_offset
+        self._buf = bytearray(nrec * self._rec_size)
+        self._buf_off = 0
+        self._buf_end = 0
+
+    def _pread(self, pos):
+        """Fill the record buffer from file position pos."""
+
+        if hasattr(os, 'preadv'):
+            return os.preadv(self._fhandle.fileno(), [self._buf], pos)
+
+        self._fhandle.seek(pos)
+        return self._fhandle.readinto(self._buf)
+
+    def _decode_events(self, nrec):
+        """
+        Find the active event codes of the first nrec records in the
+        buffer. Records without active events are left as None.
+        """
+
+        nevent = self.header.nevent
+        if nevent == 0 or nrec == 0:
+            self._events = None
+            return
+
+        ncol = self.header.nchan + nevent
+        flags = np.frombuffer(self._buf, dtype=self._dtype, count=nrec * ncol)
+        active = flags.reshape(nrec, ncol)[:, self.header.nchan:] == 1
+
+        self._events = [None] * nrec
+        for i in np.flatnonzero(active.any(axis=1)).tolist():
+            self._events[i] = self._codes_arr[active[i]].tolist()
 
     def next(self):
         """
@@ -95,33 +153,57 @@ class RawFile(object):
         Returns False,False if at the end of the file or an error was encountered.
         """
 
-        f = self._fhandle
-
-        b = f.read(self._rec_size)
-
-        if len(b) == 0:
+        left = self._buf_end - self._buf_off
+        if left < self._rec_size:
+            # Start the next chunk at the first unconsumed byte
+            self._pos -= left
+            n = self._pread(self._pos)
+            self._pos += n
+            self._buf_off = 0
+            self._buf_end = left = n
+            self._decode_events(n // self._rec_size if self._rec_size > 0 else 0)
+
+        if left == 0:
             return False, False
 
-        if len(b) < self._rec_size:
+        if left < self._rec_size:
             print("Warning: reached end of file {}/{} bytes left."
-                    .format(len(b), self._rec_size)
+                    .format(left, self._rec_size)
                     )
+            self._buf_off = self._buf_end
             return False, False
 
         # Data record stores Nchan values and then Ncode values which
         # define the event markings at each sample point.
         # Easiest to return a [] of events and [][] of signal values.
 
-        data = unpack(self._rec_fmt, b)
-        nc = self.header.nchan
-        ev_active = data[nc:]
+        off = self._buf_off
+        self._buf_off += self._rec_size
 
-        if len(ev_active) != self.header.nevent:
-            print("Error: Incorrect number of event flags. {}/{}"
-                    .format(len(ev_active), self.header.nevent)
-                    )
-            return False, False
+        data = self._chan_struct.unpack_from(self._buf, off)
+
+        e = None
+        if self._events is not None:
+            e = self._events[off // self._rec_size]
+
+        return (e if e is not None else []), data
+
+    def to_memmap(self):
+        """
+        Return all data records as a read-only (nsample, nchan+nevent)
+        memmap, one row per sample with the channel values followed by
+        the event flags. No data is copied; the mapping is released when
+        the returned array is garbage collected.
+        """
+
+        nbyte = os.path.getsize(self.filename) - self._data_offset
+        nrec = nbyte // self._rec_size if self._rec_size > 0 else 0
+        nrec = min(nrec, self.header.nsample)
+        ncol = self.header.nchan + self.header.nevent
 
-        e = [x[1] for x in zip(ev_active, self.codes) if x[0]==1]
+        if nrec == 0:
+            return np.empty((0, ncol), dtype=self._dtype)
 
-        return e, data[:nc]
+        return np.memmap(self.filename, dtype=self._dtype, mode='r',
+                offset=self._data_offset, shape=(nrec, ncol)
+                )
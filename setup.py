@@ -4,6 +4,7 @@ setup(
         name = "pyedf",
         version = "0.1",
         packages = find_packages(),
+        install_requires = ["numpy"],
 
         # Metadata
         author = "Anshul Sirur",